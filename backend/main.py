@@ -1,12 +1,15 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, validator
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import List, Optional, Dict, Any
-import pandas as pd
+from collections import OrderedDict
 import numpy as np
+import orjson
+import pyarrow as pa
 import logging
 import json
+import threading
 import traceback
 import time
 
@@ -14,7 +17,30 @@ import time
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Patient Cohort Simulator")
+# PCG64-backed Generator; much faster than the legacy module-level RandomState
+_rng = np.random.default_rng()
+
+# Above this size, Box-Muller beats the Ziggurat sampler (see _draw_normal)
+_BOX_MULLER_MIN_SIZE = 4096
+
+def _draw_normal(rng: np.random.Generator, mean: float, std: float, size: int) -> np.ndarray:
+    """Draw `size` float32 normal deviates scaled to (mean, std).
+
+    The Ziggurat sampler behind Generator.standard_normal wins for small
+    draws, but its table-miss branches defeat SIMD on large ones; Box-Muller
+    is pure vectorized sqrt/log/cos, so switch over for big cohorts (the
+    request cap is 1000 today, so this is future-proofing).
+    """
+    if size < _BOX_MULLER_MIN_SIZE:
+        deviates = rng.standard_normal(size, dtype=np.float32)
+    else:
+        u1 = rng.random(size, dtype=np.float32)
+        u2 = rng.random(size, dtype=np.float32)
+        # 1 - u1 keeps the log argument in (0, 1]; rng.random can return 0
+        deviates = np.sqrt(-2.0 * np.log(1.0 - u1)) * np.cos((2.0 * np.pi) * u2)
+    return deviates * std + mean
+
+app = FastAPI(title="Patient Cohort Simulator", default_response_class=ORJSONResponse)
 
 # Enable CORS with more specific options
 app.add_middleware(
@@ -41,6 +67,8 @@ class PatientData(BaseModel):
     lab_results: LabResults
 
 class CohortCriteria(BaseModel):
+    model_config = ConfigDict(validate_assignment=False, extra='ignore')
+
     age_mean: float = Field(default=50.0)
     age_std: float = Field(default=15.0)
     glucose_mean: float = Field(default=100.0)
@@ -50,7 +78,8 @@ class CohortCriteria(BaseModel):
     conditions: List[str] = Field(default=["Diabetes", "Hypertension", "Asthma", "Arthritis"])
     medications: List[str] = Field(default=["Metformin", "Lisinopril", "Albuterol", "Ibuprofen"])
 
-    @validator('age_std', 'glucose_std', 'cholesterol_std')
+    @field_validator('age_std', 'glucose_std', 'cholesterol_std')
+    @classmethod
     def validate_std(cls, v):
         if v <= 0:
             raise ValueError('Standard deviation must be positive')
@@ -59,6 +88,14 @@ class CohortCriteria(BaseModel):
 class CohortRequest(BaseModel):
     criteria: CohortCriteria
     size: int = Field(gt=0, le=1000)
+    seed: Optional[int] = Field(default=None, ge=0)
+
+# Seeded simulations are deterministic, so identical requests (e.g. UI slider
+# tuning) can be answered from a small LRU cache. The endpoint runs in
+# threadpool threads, so all cache access goes through the lock.
+_simulation_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+_simulation_cache_lock = threading.Lock()
+_SIMULATION_CACHE_MAX = 128
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -77,166 +114,249 @@ async def root():
     return {"message": "Patient Cohort Simulator API"}
 
 @app.post("/simulate-cohort")
-async def simulate_cohort(request: CohortRequest):
+def simulate_cohort(request: CohortRequest, format: Optional[str] = None):
+    # Plain def: FastAPI runs this CPU-bound handler in the threadpool so the
+    # numpy work doesn't block the event loop. Errors propagate to the global
+    # exception handler, which formats the traceback once.
     start_time = time.time()
-    try:
-        logger.info(f"Received cohort simulation request with size: {request.size}")
-        logger.info(f"Criteria: {request.criteria.dict()}")
-        
-        # Generate synthetic patient data based on criteria
-        patients = generate_synthetic_patients(request.criteria.dict(), request.size)
-        logger.info(f"Generated {len(patients)} synthetic patients in {time.time() - start_time:.2f} seconds")
-        
-        # Generate summary statistics
-        summary = generate_cohort_summary(patients)
-        logger.info(f"Generated cohort summary in {time.time() - start_time:.2f} seconds")
-        
-        # Simple clustering based on age ranges
-        clusters = perform_simple_clustering(patients)
-        logger.info(f"Completed clustering analysis in {time.time() - start_time:.2f} seconds")
-        
-        total_time = time.time() - start_time
-        logger.info(f"Total processing time: {total_time:.2f} seconds")
-        
-        return {
-            "cohort": patients,
-            "clusters": clusters,
-            "summary": summary,
-            "processing_time": total_time
-        }
-    except Exception as e:
-        error_detail = {
-            "detail": str(e),
-            "traceback": traceback.format_exc()
-        }
-        logger.error(f"Error in simulate_cohort: {error_detail}")
-        raise HTTPException(status_code=500, detail=error_detail)
-
-def generate_synthetic_patients(criteria: dict, size: int) -> List[dict]:
-    try:
-        logger.info(f"Generating {size} patients with criteria: {criteria}")
-        # Pre-generate random numbers for better performance
-        ages = np.random.normal(
-            criteria.get("age_mean", 50),
-            criteria.get("age_std", 15),
-            size=size
-        ).astype(int)
-        
-        genders = np.random.choice(["M", "F"], size=size, p=[0.5, 0.5])
-        
-        # Pre-generate condition and medication counts
-        condition_counts = np.random.randint(1, 4, size=size)
-        medication_counts = np.random.randint(1, 3, size=size)
-        
-        # Pre-generate lab results
-        glucose_values = np.random.normal(
-            criteria.get("glucose_mean", 100),
-            criteria.get("glucose_std", 20),
-            size=size
+    logger.info(f"Received cohort simulation request with size: {request.size}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Criteria: {request.criteria.model_dump()}")
+
+    # Columnar consumers can request the raw cohort as an Arrow IPC stream
+    # (?format=arrow); summary and clustering are skipped for downloads
+    if format == "arrow":
+        cohort = generate_synthetic_patients(request.criteria, request.size, request.seed)
+        return Response(
+            content=cohort_to_arrow_ipc(cohort),
+            media_type="application/vnd.apache.arrow.stream"
         )
-        cholesterol_values = np.random.normal(
-            criteria.get("cholesterol_mean", 200),
-            criteria.get("cholesterol_std", 40),
-            size=size
+
+    # Seeded requests are deterministic and cacheable (JSON responses only)
+    cache_key = None
+    if request.seed is not None and format is None:
+        cache_key = (request.criteria.model_dump_json(), request.size, request.seed)
+        with _simulation_cache_lock:
+            cached = _simulation_cache.get(cache_key)
+            if cached is not None:
+                _simulation_cache.move_to_end(cache_key)
+        if cached is not None:
+            logger.debug("Cache hit for seeded request")
+            return ORJSONResponse(cached)
+
+    # Generate synthetic patient data based on criteria
+    cohort = generate_synthetic_patients(request.criteria, request.size, request.seed)
+
+    # Generate summary statistics
+    summary = generate_cohort_summary(cohort)
+
+    # Simple clustering based on age ranges
+    clusters = perform_simple_clustering(cohort)
+
+    total_time = time.time() - start_time
+    logger.info(f"Total processing time: {total_time:.2f} seconds")
+
+    # The flat code arrays only exist for the summary; the ragged
+    # per-patient lists already carry the same information
+    cohort.pop("condition_codes")
+    cohort.pop("medication_codes")
+
+    # ?format=ndjson streams one patient row per line with a trailing
+    # aggregate line, so large cohorts never sit fully serialized in memory
+    if format == "ndjson":
+        return StreamingResponse(
+            stream_cohort_ndjson(cohort, clusters, summary, total_time),
+            media_type="application/x-ndjson"
         )
-        
-        patients = []
-        for i in range(size):
-            patient = {
-                "id": f"P{i+1}",
-                "age": int(ages[i]),
-                "gender": genders[i],
-                "conditions": np.random.choice(
-                    criteria.get("conditions", ["Diabetes", "Hypertension", "Asthma", "Arthritis"]),
-                    size=condition_counts[i],
-                    replace=False
-                ).tolist(),
-                "medications": np.random.choice(
-                    criteria.get("medications", ["Metformin", "Lisinopril", "Albuterol", "Ibuprofen"]),
-                    size=medication_counts[i],
-                    replace=False
-                ).tolist(),
-                "lab_results": {
-                    "glucose": float(glucose_values[i]),
-                    "cholesterol": float(cholesterol_values[i])
-                }
+
+    # orjson serializes the ndarray columns natively (OPT_SERIALIZE_NUMPY),
+    # so no tolist() conversion at the boundary
+    payload = {
+        "cohort": cohort,
+        "clusters": clusters,
+        "summary": summary,
+        "processing_time": total_time
+    }
+    if cache_key is not None:
+        with _simulation_cache_lock:
+            _simulation_cache[cache_key] = payload
+            if len(_simulation_cache) > _SIMULATION_CACHE_MAX:
+                _simulation_cache.popitem(last=False)
+    return ORJSONResponse(payload)
+
+def generate_synthetic_patients(criteria: CohortCriteria, size: int, seed: Optional[int] = None) -> Dict[str, Any]:
+    # A seed gives a dedicated Generator so the same request reproduces
+    # the same cohort; otherwise draw from the shared stream
+    rng = _rng if seed is None else np.random.default_rng(seed)
+    # Pre-generate random numbers for better performance; ages fit in
+    # int16 and lab values only need float32 precision, which halves
+    # payload size and memory traffic downstream. np.rint rounds to
+    # nearest; astype(int) truncated toward zero and biased ages low by
+    # ~0.5 on average.
+    ages = np.rint(
+        _draw_normal(rng, criteria.age_mean, criteria.age_std, size)
+    ).astype(np.int16, copy=False)
+
+    genders = rng.choice(["M", "F"], size=size, p=[0.5, 0.5])
+
+    # Pre-generate condition and medication counts
+    condition_counts = rng.integers(1, 4, size=size)
+    medication_counts = rng.integers(1, 3, size=size)
+
+    # Pre-generate lab results, drawn directly in float32
+    glucose_values = _draw_normal(rng, criteria.glucose_mean, criteria.glucose_std, size)
+    cholesterol_values = _draw_normal(rng, criteria.cholesterol_mean, criteria.cholesterol_std, size)
+
+    conditions = np.asarray(criteria.conditions)
+    medications = np.asarray(criteria.medications)
+
+    # Draw the without-replacement picks for every patient in one shot:
+    # the k smallest entries of a row of uniforms are a uniform random
+    # k-subset, so argpartition over a (size, n_categories) matrix replaces
+    # 2*size separate np.random.choice calls. Codes are int8 unless the
+    # category list is too long for it — int8 would silently wrap past 127.
+    max_conditions = int(condition_counts.max())
+    max_medications = int(medication_counts.max())
+    condition_code_dtype = np.int8 if len(conditions) <= np.iinfo(np.int8).max else np.int16
+    medication_code_dtype = np.int8 if len(medications) <= np.iinfo(np.int8).max else np.int16
+    condition_picks = np.argpartition(
+        rng.random((size, len(conditions))), max_conditions - 1, axis=1
+    )[:, :max_conditions].astype(condition_code_dtype)
+    medication_picks = np.argpartition(
+        rng.random((size, len(medications))), max_medications - 1, axis=1
+    )[:, :max_medications].astype(medication_code_dtype)
+
+    # Valid picks per row (row i keeps its first condition_counts[i] picks),
+    # flattened once here so the summary can count codes without re-walking
+    # the ragged lists
+    condition_mask = np.arange(max_conditions) < condition_counts[:, None]
+    medication_mask = np.arange(max_medications) < medication_counts[:, None]
+
+    # Structure-of-arrays layout: one column per attribute, ragged lists of
+    # integer codes into the category lists for condition/medication picks
+    return {
+        "ids": [f"P{i+1}" for i in range(size)],
+        "ages": ages,
+        "genders": genders.tolist(),
+        "glucose": glucose_values,
+        "cholesterol": cholesterol_values,
+        "conditions": [
+            condition_picks[i, :condition_counts[i]].tolist()
+            for i in range(size)
+        ],
+        "medications": [
+            medication_picks[i, :medication_counts[i]].tolist()
+            for i in range(size)
+        ],
+        "condition_categories": conditions.tolist(),
+        "medication_categories": medications.tolist(),
+        "condition_codes": condition_picks[condition_mask],
+        "medication_codes": medication_picks[medication_mask]
+    }
+
+def stream_cohort_ndjson(cohort: Dict[str, Any], clusters: dict, summary: dict, total_time: float):
+    # Reconstruct row-shaped patient records from the columns, one line per
+    # patient; the aggregates go in a final trailer line
+    condition_names = cohort["condition_categories"]
+    medication_names = cohort["medication_categories"]
+    ids = cohort["ids"]
+    ages = cohort["ages"].tolist()
+    genders = cohort["genders"]
+    glucose = cohort["glucose"].tolist()
+    cholesterol = cohort["cholesterol"].tolist()
+    conditions = cohort["conditions"]
+    medications = cohort["medications"]
+    for i in range(len(ids)):
+        yield orjson.dumps({
+            "id": ids[i],
+            "age": ages[i],
+            "gender": genders[i],
+            "conditions": [condition_names[c] for c in conditions[i]],
+            "medications": [medication_names[m] for m in medications[i]],
+            "lab_results": {
+                "glucose": glucose[i],
+                "cholesterol": cholesterol[i]
             }
-            patients.append(patient)
-        return patients
-    except Exception as e:
-        error_detail = {
-            "detail": str(e),
-            "traceback": traceback.format_exc()
-        }
-        logger.error(f"Error in generate_synthetic_patients: {error_detail}")
-        raise
-
-def perform_simple_clustering(patients: List[dict]) -> dict:
-    try:
-        logger.info("Starting simple clustering analysis")
-        # Simple clustering based on age ranges
-        age_clusters = {
-            "young": {"min": 0, "max": 30},
-            "middle": {"min": 31, "max": 60},
-            "senior": {"min": 61, "max": 100}
-        }
-        
-        # Use numpy for faster array operations
-        ages = np.array([p["age"] for p in patients])
-        cluster_assignments = np.zeros(len(patients), dtype=int)
-        cluster_assignments[ages > 60] = 2
-        cluster_assignments[(ages > 30) & (ages <= 60)] = 1
-        
-        # Calculate cluster centers
-        cluster_centers = []
-        for cluster_id in range(3):
-            cluster_ages = ages[cluster_assignments == cluster_id]
-            if len(cluster_ages) > 0:
-                avg_age = float(np.mean(cluster_ages))
-                cluster_centers.append([avg_age, 0, 0, 0, 0])
-            else:
-                cluster_centers.append([0, 0, 0, 0, 0])
-        
-        return {
-            "cluster_assignments": cluster_assignments.tolist(),
-            "cluster_centers": cluster_centers,
-            "cluster_labels": ["Young", "Middle-aged", "Senior"]
-        }
-    except Exception as e:
-        error_detail = {
-            "detail": str(e),
-            "traceback": traceback.format_exc()
-        }
-        logger.error(f"Error in perform_simple_clustering: {error_detail}")
-        raise
-
-def generate_cohort_summary(patients: List[dict]) -> dict:
-    try:
-        logger.info("Generating cohort summary")
-        # Use numpy for faster array operations
-        ages = np.array([p["age"] for p in patients])
-        conditions = [c for p in patients for c in p["conditions"]]
-        medications = [m for p in patients for m in p["medications"]]
-        
-        return {
-            "total_patients": len(patients),
-            "age_stats": {
-                "mean": float(np.mean(ages)),
-                "std": float(np.std(ages)),
-                "min": int(np.min(ages)),
-                "max": int(np.max(ages))
-            },
-            "condition_frequency": pd.Series(conditions).value_counts().to_dict(),
-            "medication_frequency": pd.Series(medications).value_counts().to_dict()
-        }
-    except Exception as e:
-        error_detail = {
-            "detail": str(e),
-            "traceback": traceback.format_exc()
-        }
-        logger.error(f"Error in generate_cohort_summary: {error_detail}")
-        raise
+        }) + b"\n"
+    yield orjson.dumps({
+        "summary": summary,
+        "clusters": clusters,
+        "processing_time": total_time
+    }) + b"\n"
+
+def cohort_to_arrow_ipc(cohort: Dict[str, Any]) -> bytes:
+    # The numpy columns convert zero-copy; the ragged code lists are built
+    # with an explicit list<int8/int16> type matching the code arrays, since
+    # pa.table would otherwise infer list<int64> from the Python ints.
+    # Category lists ride along as schema metadata so consumers can decode
+    # the codes.
+    condition_code_type = pa.from_numpy_dtype(cohort["condition_codes"].dtype)
+    medication_code_type = pa.from_numpy_dtype(cohort["medication_codes"].dtype)
+    table = pa.table({
+        "id": cohort["ids"],
+        "age": cohort["ages"],
+        "gender": cohort["genders"],
+        "glucose": cohort["glucose"],
+        "cholesterol": cohort["cholesterol"],
+        "conditions": pa.array(cohort["conditions"], type=pa.list_(condition_code_type)),
+        "medications": pa.array(cohort["medications"], type=pa.list_(medication_code_type))
+    })
+    table = table.replace_schema_metadata({
+        "condition_categories": json.dumps(cohort["condition_categories"]),
+        "medication_categories": json.dumps(cohort["medication_categories"])
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def perform_simple_clustering(cohort: Dict[str, Any]) -> dict:
+    # Simple clustering based on age ranges
+    age_clusters = {
+        "young": {"min": 0, "max": 30},
+        "middle": {"min": 31, "max": 60},
+        "senior": {"min": 61, "max": 100}
+    }
+
+    # Operate on the age column directly; bin edges at 31 and 61 map ages
+    # to young/middle/senior in a single pass
+    ages = cohort["ages"]
+    cluster_assignments = np.digitize(ages, np.array([31, 61])).astype(np.int32)
+
+    # Calculate cluster centers: per-cluster age sums and sizes in one
+    # bincount pass each, then a branchless mean (empty clusters get 0)
+    age_sums = np.bincount(cluster_assignments, weights=ages, minlength=3)
+    cluster_sizes = np.bincount(cluster_assignments, minlength=3)
+    avg_ages = np.where(cluster_sizes > 0, age_sums / np.maximum(cluster_sizes, 1), 0.0)
+    cluster_centers = np.zeros((3, 5))
+    cluster_centers[:, 0] = avg_ages
+
+    return {
+        "cluster_assignments": cluster_assignments.tolist(),
+        "cluster_centers": cluster_centers.tolist(),
+        "cluster_labels": ["Young", "Middle-aged", "Senior"]
+    }
+
+def generate_cohort_summary(cohort: Dict[str, Any]) -> dict:
+    # Operate on the columns directly
+    ages = cohort["ages"]
+    condition_names = np.asarray(cohort["condition_categories"])
+    medication_names = np.asarray(cohort["medication_categories"])
+    cond_codes, cond_counts = np.unique(cohort["condition_codes"], return_counts=True)
+    med_codes, med_counts = np.unique(cohort["medication_codes"], return_counts=True)
+
+    return {
+        "total_patients": len(cohort["ids"]),
+        "age_stats": {
+            "mean": float(np.mean(ages)),
+            "std": float(np.std(ages)),
+            "min": int(np.min(ages)),
+            "max": int(np.max(ages))
+        },
+        "condition_frequency": dict(zip(condition_names[cond_codes].tolist(), cond_counts.tolist())),
+        "medication_frequency": dict(zip(medication_names[med_codes].tolist(), med_counts.tolist()))
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)